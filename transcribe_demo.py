@@ -1,16 +1,382 @@
 #! python3.7
 
 import argparse
+import io
+import math
 import os
-from datetime import datetime, timedelta
-from queue import Queue
+import shutil
+import sys
+import threading
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from sys import platform
-from time import sleep
+from typing import List
 
 import numpy as np
-import speech_recognition as sr
-import torch
-import whisper
+
+# torch, whisper and speech_recognition take seconds to import, so they're only imported once they're actually
+# needed. That keeps --help, argument errors and listing microphones fast.
+
+# Whisper models are trained on 16khz audio.
+SAMPLE_RATE = 16000
+# Largest magnitude of a 16 bit signed sample, used to scale recordings into [-1, 1].
+AUDIO_NORMALIZATION_FACTOR = 32768.0
+# Whisper processes audio in 30 second windows.
+WINDOW_SAMPLES = SAMPLE_RATE * 30
+
+# Whisper's default temperatures, each one is only tried if decoding at the previous one failed its quality checks.
+FALLBACK_TEMPERATURES = (0.0, 0.2, 0.4, 0.6, 0.8, 1.0)
+
+# Where exported and compiled OpenVINO models are kept between runs.
+OPENVINO_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "whisper_openvino")
+
+# Reusable output buffer for convert_audio_to_numpy, sized for Whisper's window.
+_AUDIO_BUF = np.empty(WINDOW_SAMPLES, dtype=np.float32)
+
+
+@lru_cache(maxsize=None)
+def get_device() -> str:
+    """
+    Returns the device models should run on, "cuda" if available and "cpu" otherwise. Only looked up once.
+    """
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class FasterWhisperModel:
+    """
+    Thin wrapper around faster_whisper.WhisperModel (CTranslate2 backend) that mimics the
+    openai-whisper transcribe() result so the main loop doesn't need to care which backend is loaded.
+    """
+    def __init__(self, model: str, english_only: bool, compute_type: str):
+        # Only needed for this backend, so don't make everyone install it.
+        from faster_whisper import WhisperModel
+
+        self.language = "en" if english_only else None
+        self.model = WhisperModel(model, device=get_device(),
+                                  compute_type=compute_type)
+
+    def transcribe(self, audio: np.ndarray, initial_prompt: str = None, temperature=FALLBACK_TEMPERATURES,
+                   condition_on_previous_text: bool = True, **_) -> dict:
+        segments, _info = self.model.transcribe(audio, beam_size=1, vad_filter=False, language=self.language,
+                                                initial_prompt=initial_prompt, temperature=temperature,
+                                                condition_on_previous_text=condition_on_previous_text)
+        # Segments is a generator, decoding only happens as we iterate over it.
+        segments = [{'text': seg.text, 'no_speech_prob': seg.no_speech_prob} for seg in segments]
+        return {'text': ''.join(seg['text'] for seg in segments), 'segments': segments}
+
+
+class OpenVINOWhisperModel:
+    """
+    Thin wrapper around optimum-intel's OpenVINO Whisper model that mimics the openai-whisper transcribe() result.
+    The exported model and OpenVINO's compiled blobs are cached, so only the first run pays for converting them.
+    The previous text of the phrase isn't passed along as a prompt by this backend.
+    """
+    def __init__(self, model: str):
+        # Only needed for this backend, so don't make everyone install it.
+        from optimum.intel import OVModelForSpeechSeq2Seq
+        from transformers import AutoProcessor
+
+        model_dir = os.path.join(OPENVINO_CACHE_DIR, model)
+        ov_config = {"CACHE_DIR": os.path.join(OPENVINO_CACHE_DIR, "compiled")}
+        # The processor is saved last, so its config only exists once the exported model has been fully saved.
+        # A run interrupted while saving the model will export it again instead of loading a broken cache.
+        if (os.path.isfile(os.path.join(model_dir, "openvino_encoder_model.xml"))
+                and os.path.isfile(os.path.join(model_dir, "preprocessor_config.json"))):
+            self.processor = AutoProcessor.from_pretrained(model_dir)
+            self.model = OVModelForSpeechSeq2Seq.from_pretrained(model_dir, device="AUTO", ov_config=ov_config)
+        else:
+            self.processor = AutoProcessor.from_pretrained(f"openai/whisper-{model}")
+            self.model = OVModelForSpeechSeq2Seq.from_pretrained(f"openai/whisper-{model}", export=True,
+                                                                 device="AUTO", ov_config=ov_config)
+            self.model.save_pretrained(model_dir)
+            self.processor.save_pretrained(model_dir)
+
+    def transcribe(self, audio: np.ndarray, **_) -> dict:
+        features = self.processor(audio, sampling_rate=SAMPLE_RATE, return_tensors="pt").input_features
+        tokens = self.model.generate(features)
+        return {'text': self.processor.batch_decode(tokens, skip_special_tokens=True)[0], 'segments': []}
+
+
+class StreamingWhisper:
+    """
+    Transcribes a phrase one recording at a time. Every recording is only run through the model once,
+    the text of the earlier recordings in the phrase is handed to the decoder as its prompt instead.
+    """
+    def __init__(self, audio_model, fp16: bool, temperature_fallback: bool = False, device: str = None):
+        self.audio_model = audio_model
+        self.fp16 = fp16
+        self.device = device
+        if device == "cuda":
+            import torch
+
+            # Staging buffers for copying audio to the GPU, see _to_device.
+            self.pinned_audio = torch.empty(WINDOW_SAMPLES, dtype=torch.float32, pin_memory=True)
+            self.device_audio = torch.empty(WINDOW_SAMPLES, dtype=torch.float32, device=device)
+        # Greedy decoding runs the decoder exactly once per recording. With the fallback a recording that fails
+        # Whisper's quality checks is decoded again at higher temperatures, up to six times in total.
+        self.temperature = FALLBACK_TEMPERATURES if temperature_fallback else 0.0
+        # Text transcribed so far for the current phrase.
+        self.phrase_text = ''
+
+    def transcribe(self, audio: np.ndarray, phrase_complete: bool) -> str:
+        """
+        Transcribes the newest recording and returns the text of the whole phrase so far.
+        audio: Audio recorded since the last call.
+        phrase_complete: Whether this recording starts a new phrase, which drops the previous context.
+        """
+        if phrase_complete:
+            self.phrase_text = ''
+        result = self.audio_model.transcribe(self._to_device(audio), fp16=self.fp16,
+                                             initial_prompt=self.phrase_text.strip() or None,
+                                             temperature=self.temperature, condition_on_previous_text=False,
+                                             no_speech_threshold=0.6, logprob_threshold=-1.0,
+                                             compression_ratio_threshold=2.4)
+        # Whisper's text already starts with a space where the language uses one, so don't add our own.
+        self.phrase_text += result['text']
+        return self.phrase_text.strip()
+
+    def _to_device(self, audio: np.ndarray):
+        """
+        Hands the audio to Whisper as a tensor already on the GPU when running on CUDA. Whisper then computes the
+        mel spectrogram on the GPU too, instead of on the CPU followed by a synchronous copy of the much larger
+        spectrogram. The copy goes through pinned memory so it's a single asynchronous DMA transfer.
+        """
+        if self.device != "cuda":
+            return audio
+        import torch
+
+        if audio.size > self.pinned_audio.numel():
+            self.pinned_audio = torch.empty(audio.size, dtype=torch.float32, pin_memory=True)
+            self.device_audio = torch.empty(audio.size, dtype=torch.float32, device=self.device)
+        pinned = self.pinned_audio[:audio.size]
+        pinned.copy_(torch.from_numpy(audio))
+        # Ordered before the model's own work on the same stream, and the previous transcription has finished reading
+        # both buffers by the time we return, so reusing them is safe. There's deliberately no side stream for the
+        # copy or the spectrogram: recordings are transcribed one after another on a single worker, so there's no
+        # previous decode still running for them to overlap with.
+        return self.device_audio[:audio.size].copy_(pinned, non_blocking=True)
+
+
+class AudioRingBuffer:
+    """
+    Single producer / single consumer ring buffer for handing raw audio from the recording thread to the main thread.
+    The producer only ever advances write_idx and the consumer only read_idx, so neither side needs a lock.
+    """
+    def __init__(self, size: int):
+        self.buffer = bytearray(size)
+        self.write_idx = 0
+        self.read_idx = 0
+        # Set whenever new audio is written so the consumer can block instead of polling.
+        self.data_ready = threading.Event()
+
+    def write(self, data: bytes) -> None:
+        """
+        Copies data into the ring. Called from the recording thread.
+        data: Raw audio bytes, must be smaller than the ring itself.
+        """
+        data = memoryview(data)
+        size = len(self.buffer)
+        start = self.write_idx % size
+        first = min(len(data), size - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        # Only publish the new data once it has been fully copied in.
+        self.write_idx += len(data)
+        self.data_ready.set()
+
+    def read(self) -> List[np.ndarray]:
+        """
+        Returns all audio written since the last read as 16 bit sample views straight into the ring, split in two
+        where it wraps around. The views aren't copied, so use them before the producer can lap the ring again.
+        Called from the main thread. If the producer has lapped us only the newest ring's worth of audio is returned.
+        """
+        self.data_ready.clear()
+        write_idx = self.write_idx
+        size = len(self.buffer)
+        read_idx = max(self.read_idx, write_idx - size)
+        self.read_idx = write_idx
+        if read_idx == write_idx:
+            return []
+        start, end = read_idx % size, write_idx % size
+        if start < end:
+            return [self._samples(start, end)]
+        return [self._samples(start, size), self._samples(0, end)]
+
+    def _samples(self, start: int, end: int) -> np.ndarray:
+        return np.frombuffer(self.buffer, dtype=np.int16, count=(end - start) // 2, offset=start)
+
+
+def convert_audio_to_numpy(chunks: List[np.ndarray]) -> np.ndarray:
+    """
+    Converts 16 bit PCM audio into the single float32 array Whisper expects.
+    The returned array is a view into a shared buffer and is only valid until the next call.
+    chunks: 16 bit samples from the microphone, in order.
+    """
+    global _AUDIO_BUF
+    size = sum(chunk.size for chunk in chunks)
+    if size > _AUDIO_BUF.size:
+        _AUDIO_BUF = np.empty(size, dtype=np.float32)
+    out = _AUDIO_BUF[:size]
+    # Scale, cast and concatenate in a single pass, multiplying by the reciprocal is cheaper than dividing.
+    offset = 0
+    for chunk in chunks:
+        np.multiply(chunk, np.float32(1.0 / AUDIO_NORMALIZATION_FACTOR), out=out[offset:offset + chunk.size])
+        offset += chunk.size
+    return out
+
+
+def trim_backlog(pending_audio: deque, max_samples: int) -> int:
+    """
+    Drops the oldest queued audio until no more than max_samples are waiting for the model, so falling behind
+    can't make the latency grow without bound. Returns the number of samples dropped.
+    pending_audio: Queued recordings as [phrase_complete, audio], oldest first.
+    max_samples: How many samples are allowed to wait.
+    """
+    dropped = 0
+    backlog = sum(audio.size for _, audio in pending_audio)
+    while backlog > max_samples:
+        phrase_complete, audio = pending_audio[0]
+        excess = backlog - max_samples
+        if audio.size > excess:
+            pending_audio[0][1] = audio[excess:]
+            dropped += excess
+            break
+        pending_audio.popleft()
+        # The start of a phrase may be gone, but the following audio still belongs on a new line.
+        if phrase_complete and pending_audio:
+            pending_audio[0][0] = True
+        dropped += audio.size
+        backlog -= audio.size
+    return dropped
+
+
+def stdout_is_terminal() -> bool:
+    """
+    Whether stdout is an interactive terminal that understands ANSI escape sequences, rather than a file or pipe.
+    """
+    try:
+        return sys.stdout.isatty()
+    except (AttributeError, ValueError):
+        return False
+
+
+def clear_console() -> None:
+    """
+    Clears the terminal with an ANSI escape sequence rather than spawning a cls / clear process.
+    Does nothing when stdout isn't a terminal, there's nothing to clear in a file or pipe.
+    """
+    if stdout_is_terminal():
+        sys.stdout.write("\x1b[2J\x1b[H")
+        sys.stdout.flush()
+
+
+def display_width(text: str) -> int:
+    """
+    Returns how many terminal columns text takes up, wide characters such as CJK take up two.
+    """
+    return sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1 for c in text)
+
+
+def display_transcription(text: str, phrase_complete: bool, previous_text: str) -> None:
+    """
+    Updates the transcription on screen by redrawing only the line being transcribed, or starting a new line
+    when the phrase is complete, instead of reprinting the whole transcription every time.
+    text: The newest text for the phrase.
+    phrase_complete: Whether text starts a new phrase.
+    previous_text: The text currently shown on the last line.
+    """
+    if not stdout_is_terminal():
+        # Lines can't be redrawn in a file or pipe, so only write them out once they're complete.
+        if phrase_complete:
+            sys.stdout.write(previous_text + '\n')
+            sys.stdout.flush()
+        return
+    if phrase_complete:
+        sys.stdout.write('\n' + text)
+    else:
+        # Go back to the start of the last line, which may have wrapped over several rows, and clear from there.
+        rows = max(display_width(previous_text) - 1, 0) // shutil.get_terminal_size().columns
+        sys.stdout.write(f'\x1b[{rows}F' if rows else '\r')
+        sys.stdout.write('\x1b[J' + text)
+    sys.stdout.flush()
+
+
+def print_dropped_audio(dropped_samples: int) -> None:
+    """
+    Reports audio dropped to stay real time on a line of its own, after the line currently being transcribed.
+    dropped_samples: How many samples were dropped.
+    """
+    message = f'[Dropped {dropped_samples / SAMPLE_RATE:.1f}s of audio to keep up]'
+    # Outside a terminal only completed lines are written, so this goes on a line of its own straight away.
+    sys.stdout.write('\n' + message if stdout_is_terminal() else message + '\n')
+    sys.stdout.flush()
+
+
+def load_speech_detector(vad: str, silence_threshold: float):
+    """
+    Returns a function telling whether a chunk of audio contains speech, so silence can skip the model entirely.
+    vad: "silero" for the Silero VAD model, "energy" for a plain RMS check or "none" to transcribe everything.
+    silence_threshold: RMS level below which the energy check considers audio silent.
+    """
+    if vad == "silero":
+        import torch
+        vad_model, utils = torch.hub.load('snakers4/silero-vad', 'silero_vad')
+        get_speech_timestamps = utils[0]
+        return lambda audio: bool(get_speech_timestamps(torch.from_numpy(audio), vad_model, sampling_rate=SAMPLE_RATE))
+    if vad == "energy":
+        # Mean square energy, np.dot avoids allocating a squared copy of the audio.
+        min_energy = silence_threshold ** 2
+        return lambda audio: np.dot(audio, audio) / audio.size >= min_energy
+    return lambda audio: True
+
+
+def load_whisper_model(model: str, non_english: bool, backend: str, compute_type: str, compile: bool = False):
+    """
+    Loads / downloads the requested Whisper model for the given backend.
+    model: Model size, e.g. "medium".
+    non_english: Use the multilingual model instead of the english only one.
+    backend: "pytorch" for openai-whisper, "ctranslate2" for faster-whisper or "openvino" for optimum-intel.
+    compute_type: Precision of the model weights, one of "float32", "float16" or "int8". Not used by openvino.
+    compile: torch.compile the encoder and decoder, only used by the pytorch backend.
+    """
+    english_only = model != "large" and not non_english
+    if english_only:
+        model = model + ".en"
+    if backend == "ctranslate2":
+        return FasterWhisperModel(model, english_only, compute_type)
+    if backend == "openvino":
+        return OpenVINOWhisperModel(model)
+
+    import torch
+    import whisper
+
+    # quantize_dynamic only has CPU kernels, so an int8 model has to live on the CPU even when CUDA is available.
+    audio_model = whisper.load_model(model, device="cpu" if compute_type == "int8" else None)
+    if compute_type == "float16":
+        audio_model = audio_model.half()
+        # Whisper's LayerNorm always runs in float32, so keep its weights there.
+        for module in audio_model.modules():
+            if isinstance(module, torch.nn.LayerNorm):
+                module.float()
+    elif compute_type == "int8":
+        # Whisper uses its own nn.Linear subclass which quantize_dynamic won't swap out.
+        # On the CPU it behaves exactly like a plain nn.Linear, so just treat it as one.
+        for module in audio_model.modules():
+            if isinstance(module, torch.nn.Linear):
+                module.__class__ = torch.nn.Linear
+        audio_model = torch.quantization.quantize_dynamic(audio_model, {torch.nn.Linear}, dtype=torch.qint8)
+    if compile:
+        # Compilation happens lazily on the first forward pass, see the warm up in main().
+        # Whisper always pads or trims the mel spectrogram to a 30 second window, so the encoder only ever sees one
+        # shape and can be specialized and captured into CUDA graphs. The decoder's inputs grow by a token every step,
+        # compile it for dynamic shapes so it isn't recompiled for every new sequence length.
+        audio_model.encoder = torch.compile(audio_model.encoder, mode="reduce-overhead", dynamic=False, fullgraph=False)
+        audio_model.decoder = torch.compile(audio_model.decoder, dynamic=True, fullgraph=False)
+    return audio_model
 
 
 def main():
@@ -19,23 +385,59 @@ def main():
                         choices=["tiny", "base", "small", "medium", "large"])
     parser.add_argument("--non_english", action='store_true',
                         help="Don't use the english model.")
+    parser.add_argument("--backend", default="pytorch", help="Inference backend to use. "
+                        "ctranslate2 requires the faster-whisper package, "
+                        "openvino requires optimum-intel and is best suited to Intel GPUs and NPUs.",
+                        choices=["pytorch", "ctranslate2", "openvino"])
+    parser.add_argument("--compute_type", default="auto", help="Precision of the model weights. "
+                        "auto uses float16 on CUDA and int8 on the CPU. float16 requires CUDA. "
+                        "Not used by the openvino backend.",
+                        choices=["auto", "float32", "float16", "int8"])
+    parser.add_argument("--compile", action='store_true',
+                        help="torch.compile the model. Slow to start but faster once warmed up. "
+                             "Only used by the pytorch backend.")
+    parser.add_argument("--temperature_fallback", action='store_true',
+                        help="Decode recordings that fail Whisper's quality checks again at higher temperatures. "
+                             "Can be more accurate on difficult audio, but a recording may then be decoded up to "
+                             "six times, making latency much less predictable.")
+    parser.add_argument("--output_file", default=None,
+                        help="File to write the transcription to as it is transcribed.", type=str)
     parser.add_argument("--energy_threshold", default=1000,
                         help="Energy level for mic to detect.", type=int)
+    parser.add_argument("--vad", default="none", help="How to detect recordings without speech, "
+                        "which are skipped instead of transcribed. silero downloads the Silero VAD model.",
+                        choices=["none", "energy", "silero"])
+    parser.add_argument("--silence_threshold", default=0.01,
+                        help="RMS level, from 0 to 1, below which a recording counts as silence for the energy VAD. "
+                             "This is checked on top of --energy_threshold, which is on a 0 to 32768 scale, "
+                             "so it must not be above --energy_threshold / 32768 or speech the microphone "
+                             "picked up gets dropped.", type=float)
     parser.add_argument("--record_timeout", default=2,
                         help="How real time the recording is in seconds.", type=float)
     parser.add_argument("--phrase_timeout", default=3,
                         help="How much empty space between recordings before we "
                              "consider it a new line in the transcription.", type=float)
+    parser.add_argument("--max_backlog", default=30,
+                        help="How many seconds of audio may queue up while the model is busy "
+                             "before the oldest is dropped to stay real time. "
+                             "Must be at least --record_timeout.", type=float)
     if 'linux' in platform:
         parser.add_argument("--default_microphone", default='pulse',
                             help="Default microphone name for SpeechRecognition. "
                                  "Run this with 'list' to view available Microphones.", type=str)
     args = parser.parse_args()
+    if args.max_backlog < args.record_timeout:
+        parser.error("--max_backlog must be at least --record_timeout")
+    if args.vad == "energy" and args.silence_threshold * AUDIO_NORMALIZATION_FACTOR > args.energy_threshold:
+        parser.error("--silence_threshold must not be above --energy_threshold / 32768")
+
+    import speech_recognition as sr
 
     # The last time a recording was retrieved from the queue.
     phrase_time = None
-    # Thread safe Queue for passing data from the threaded recording callback.
-    data_queue = Queue()
+    # Lock free ring buffer for passing data from the threaded recording callback. Holds a minute of 16 bit audio,
+    # or two recordings if they're longer, since a single write must never be larger than the ring.
+    audio_buffer = AudioRingBuffer(SAMPLE_RATE * 2 * math.ceil(max(60, 2 * args.record_timeout)))
     # We use SpeechRecognizer to record our audio because it has a nice feature where it can detect when speech ends.
     recorder = sr.Recognizer()
     recorder.energy_threshold = args.energy_threshold
@@ -54,21 +456,46 @@ def main():
         else:
             for index, name in enumerate(sr.Microphone.list_microphone_names()):
                 if mic_name in name:
-                    source = sr.Microphone(sample_rate=16000, device_index=index)
+                    source = sr.Microphone(sample_rate=SAMPLE_RATE, device_index=index)
                     break
     else:
-        source = sr.Microphone(sample_rate=16000)
+        source = sr.Microphone(sample_rate=SAMPLE_RATE)
 
     # Load / Download model
-    model = args.model
-    if args.model != "large" and not args.non_english:
-        model = model + ".en"
-    audio_model = whisper.load_model(model)
+    compute_type = args.compute_type
+    if compute_type == "auto":
+        compute_type = "float16" if get_device() == "cuda" else "int8"
+    elif compute_type == "float16" and args.backend != "openvino" and get_device() != "cuda":
+        parser.error("--compute_type float16 requires CUDA")
+    # Whisper is fed float16 audio only when the weights are float16 too.
+    use_fp16 = compute_type == "float16"
+    audio_model = load_whisper_model(args.model, args.non_english, args.backend, compute_type, args.compile)
+    is_speech = load_speech_detector(args.vad, args.silence_threshold)
+    # Transcription runs on a worker thread so the main thread is free to keep taking in audio and updating the
+    # display. A single worker keeps recordings in order, which StreamingWhisper relies on.
+    executor = ThreadPoolExecutor(max_workers=1)
+    # Warm up the model on a second of silence so the first real recording doesn't pay for
+    # one-time setup like kernel selection, or compilation when --compile is used.
+    # This has to happen on the worker, CUDA graphs captured by torch.compile are tied to the thread that ran them.
+    executor.submit(audio_model.transcribe, np.zeros(SAMPLE_RATE, dtype=np.float32), fp16=use_fp16).result()
+    # Only the pytorch backend accepts audio that's already on the GPU.
+    streaming_model = StreamingWhisper(audio_model, fp16=use_fp16, temperature_fallback=args.temperature_fallback,
+                                       device=audio_model.device.type if args.backend == "pytorch" else None)
 
     record_timeout = args.record_timeout
     phrase_timeout = args.phrase_timeout
 
-    transcription = ['']
+    # Completed lines of the transcription, and the line that's still being transcribed.
+    transcription = io.StringIO()
+    current_line = ''
+
+    # Opened once. Each update appends a line or rewrites only the last one in place, so it costs the same
+    # however long we run.
+    output_file = None
+    if args.output_file:
+        output_file = open(args.output_file, 'w', encoding='utf-8', buffering=1)
+    # Where the line currently being transcribed starts in the output file.
+    last_line_offset = 0
 
     with source:
         recorder.adjust_for_ambient_noise(source)
@@ -78,65 +505,116 @@ def main():
         Threaded callback function to receive audio data when recordings finish.
         audio: An AudioData containing the recorded bytes.
         """
-        # Grab the raw bytes and push it into the thread safe queue.
+        # Grab the raw bytes and push it into the ring buffer.
         data = audio.get_raw_data()
-        data_queue.put(data)
+        audio_buffer.write(data)
 
     # Create a background thread that will pass us raw audio bytes.
     # We could do this manually but SpeechRecognizer provides a nice helper.
     recorder.listen_in_background(source, record_callback, phrase_time_limit=record_timeout)
 
-    # Cue the user that we're ready to go.
+    # Running any command turns on ANSI escape sequence handling in the Windows console, which clear_console uses.
+    if os.name == 'nt':
+        os.system('')
+
+    # Cue the user that we're ready to go, updates are drawn below this from here on.
+    clear_console()
     print("Model loaded.\n")
 
+    max_backlog_samples = int(args.max_backlog * SAMPLE_RATE)
+    # Audio dropped from the backlog since it was last reported.
+    dropped_samples = 0
+    # The transcription running on the worker, with whether it starts a new phrase.
+    transcribing = None
+    # Recordings waiting for the worker as [phrase_complete, audio], batched into one entry per phrase
+    # and Whisper window. The main thread empties the ring buffer into this straight away, so this is where a
+    # backlog builds up when the model can't keep up; trim_backlog keeps it within --max_backlog.
+    pending_audio = deque()
+
     while True:
         try:
-            now = datetime.utcnow()
-            # Pull raw recorded audio from the queue.
-            if not data_queue.empty():
-                phrase_complete = False
-                # If enough time has passed between recordings, consider the phrase complete.
-                # Clear the current working audio buffer to start over with the new data.
-                if phrase_time and now - phrase_time > timedelta(seconds=phrase_timeout):
-                    phrase_complete = True
-                # This is the last time we received new audio data from the queue.
-                phrase_time = now
-                
-                # Combine audio data from queue
-                audio_data = b''.join(data_queue.queue)
-                data_queue.queue.clear()
-                
+            # Sleep until the recording thread hands us audio or the worker finishes, there's no polling interval
+            # to add latency. The timeout only bounds how long KeyboardInterrupt can go unnoticed on platforms
+            # where waits can't be interrupted (Windows), nothing can happen before a phrase times out anyway.
+            audio_buffer.data_ready.wait(phrase_timeout)
+
+            # Pull all raw recorded audio from the ring buffer.
+            audio_chunks = audio_buffer.read()
+            if audio_chunks:
                 # Convert in-ram buffer to something the model can use directly without needing a temp file.
-                # Convert data from 16 bit wide integers to floating point with a width of 32 bits.
-                # Clamp the audio stream frequency to a PCM wavelength compatible default of 32768hz max.
-                audio_np = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
+                audio_np = convert_audio_to_numpy(audio_chunks)
+                # Don't spend a whole model pass on silence. Skipped audio also doesn't count as part
+                # of the phrase, so a pause still starts a new line.
+                if is_speech(audio_np):
+                    now = time.monotonic()
+                    phrase_complete = False
+                    # If enough time has passed between recordings, consider the phrase complete.
+                    # Clear the current working audio buffer to start over with the new data.
+                    if phrase_time is not None and now - phrase_time > phrase_timeout:
+                        phrase_complete = True
+                    # This is the last time we received new audio data from the queue.
+                    phrase_time = now
 
+                    # Queue the recording for the worker. It gets its own copy since audio_np is reused by the next
+                    # conversion. While they wait, recordings from the same phrase are merged for as long as they
+                    # fit into a single Whisper window, so a backlog is worked off in as few model passes as possible.
+                    if (pending_audio and not phrase_complete
+                            and pending_audio[-1][1].size + audio_np.size <= WINDOW_SAMPLES):
+                        pending_audio[-1][1] = np.concatenate((pending_audio[-1][1], audio_np))
+                    else:
+                        pending_audio.append([phrase_complete, audio_np.copy()])
+
+            if transcribing and transcribing[0].done():
+                future, phrase_complete = transcribing
+                transcribing = None
                 # Read the transcription.
-                result = audio_model.transcribe(audio_np, fp16=torch.cuda.is_available())
-                text = result['text'].strip()
+                text = future.result()
+
+                # Report dropped audio between lines, display_transcription can only redraw the last line.
+                if phrase_complete and dropped_samples:
+                    print_dropped_audio(dropped_samples)
+                    dropped_samples = 0
+
+                # Only redraw what changed.
+                display_transcription(text, phrase_complete, current_line)
 
-                # If we detected a pause between recordings, add a new item to our transcription.
+                # If we detected a pause between recordings, the current line is done and we start a new one.
                 # Otherwise edit the existing one.
                 if phrase_complete:
-                    transcription.append(text)
-                else:
-                    transcription[-1] = text
-
-                # Clear the console to reprint the updated transcription.
-                os.system('cls' if os.name=='nt' else 'clear')
-                for line in transcription:
-                    print(line)
-                # Flush stdout.
-                print('', end='', flush=True)
-            else:
-                # Infinite loops are bad for processors, must sleep.
-                sleep(0.25)
+                    transcription.write(current_line + '\n')
+                current_line = text
+
+                # Append a new line to the output file or rewrite the last one in place.
+                if output_file:
+                    if phrase_complete:
+                        last_line_offset = output_file.tell()
+                    output_file.seek(last_line_offset)
+                    output_file.write(text + '\n' if text else '')
+                    output_file.truncate()
+
+            # Hand the oldest queued audio to the worker as soon as it's free.
+            if not transcribing and pending_audio:
+                phrase_complete, audio_np = pending_audio.popleft()
+                future = executor.submit(streaming_model.transcribe, audio_np, phrase_complete)
+                # Wake the main loop up when it's done.
+                future.add_done_callback(lambda _: audio_buffer.data_ready.set())
+                transcribing = (future, phrase_complete)
+
+            # Whatever is still queued now is waiting on a busy worker, keep that backlog bounded.
+            dropped_samples += trim_backlog(pending_audio, max_backlog_samples)
         except KeyboardInterrupt:
             break
 
+    executor.shutdown(wait=False)
+
+    if dropped_samples:
+        print_dropped_audio(dropped_samples)
+
+    if output_file:
+        output_file.close()
+
     print("\n\nTranscription:")
-    for line in transcription:
-        print(line)
+    print(transcription.getvalue() + current_line)
 
 if __name__ == "__main__":
     main()